@@ -1,22 +1,39 @@
 from __future__ import annotations
 
+import argparse
+import asyncio
 import hashlib
+import json
+import logging
+import math
 import secrets
 import sqlite3
+import threading
+import time
 import uuid
+import zlib
+from collections import OrderedDict
 from contextlib import contextmanager
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Iterator, Optional
+from typing import Callable, Iterator, Optional, Sequence
 import os
 from dotenv import load_dotenv
 from io import BytesIO
 from PIL import Image
 
-from fastapi import FastAPI, HTTPException, Query, Request, Response, UploadFile, File
-from fastapi.responses import FileResponse, RedirectResponse
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, EmailStr, Field
+from starlette.datastructures import Headers, MutableHeaders, UploadFile
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, fall back to gzip only
+    brotli = None
 
 # Load environment variables from .env file
 ROOT_DIR = Path(__file__).resolve().parents[1]
@@ -25,7 +42,121 @@ DB_PATH = ROOT_DIR / "app" / "data.db"
 UPLOADS_DIR = ROOT_DIR / "app" / "uploads"
 UPLOADS_DIR.mkdir(exist_ok=True)
 
+logger = logging.getLogger(__name__)
+
+# Responses smaller than this are sent uncompressed
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSIBLE_TYPES = ("application/json", "application/javascript", "image/svg+xml", "text/")
+# Rows per chunk when streaming JSON arrays
+STREAM_BATCH_ROWS = 100
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """Pick br or gzip from an Accept-Encoding header, honouring q-values."""
+    offered: dict[str, float] = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        offered[name.strip()] = q
+    candidates = ["br", "gzip"] if brotli is not None else ["gzip"]
+    best = max(candidates, key=lambda name: offered.get(name, offered.get("*", 0.0)))
+    return best if offered.get(best, offered.get("*", 0.0)) > 0 else None
+
+
+class Compressor:
+    def __init__(self, encoding: str) -> None:
+        self.encoding = encoding
+        if encoding == "br":
+            self._br = brotli.Compressor(quality=5)
+        else:
+            self._gz = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        # Non-final chunks are flushed so streamed rows reach the client right away
+        if self.encoding == "br":
+            out = self._br.process(data)
+            return out + (self._br.finish() if final else self._br.flush())
+        out = self._gz.compress(data)
+        return out + (self._gz.flush() if final else self._gz.flush(zlib.Z_SYNC_FLUSH))
+
+
+class CompressionMiddleware:
+    """Negotiated br/gzip compression for text and JSON responses, including streamed ones."""
+
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESSION_MIN_SIZE) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start: Optional[Message] = None
+        compressor: Optional[Compressor] = None
+        passthrough = False
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start, compressor, passthrough
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                content_type = headers.get("content-type", "")
+                passthrough = (
+                    "content-encoding" in headers
+                    or message["status"] == 206
+                    or not content_type.startswith(COMPRESSIBLE_TYPES)
+                )
+                if passthrough:
+                    await send(message)
+                else:
+                    start = message
+                return
+            if passthrough or message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start is not None:
+                headers = MutableHeaders(raw=start["headers"])
+                headers.add_vary_header("Accept-Encoding")
+                if not more_body and len(body) < self.minimum_size:
+                    passthrough = True
+                    await send(start)
+                    await send(message)
+                    return
+                compressor = Compressor(encoding)
+                body = compressor.compress(body, final=not more_body)
+                headers["Content-Encoding"] = encoding
+                # A strong ETag must differ between content-codings
+                etag = headers.get("etag")
+                if etag and not etag.startswith("W/"):
+                    headers["ETag"] = f"W/{etag}"
+                if more_body:
+                    del headers["Content-Length"]
+                else:
+                    headers["Content-Length"] = str(len(body))
+                await send(start)
+                start = None
+            else:
+                body = compressor.compress(body, final=not more_body)
+            await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+
 app = FastAPI(title="Marketplace API", version="0.1.0")
+app.add_middleware(CompressionMiddleware)
 app.mount("/static", StaticFiles(directory=ROOT_DIR), name="static")
 app.mount("/uploads", StaticFiles(directory=UPLOADS_DIR), name="uploads")
 
@@ -39,6 +170,27 @@ ADMIN_PAGE = ROOT_DIR / "admin.html"
 SESSION_COOKIE = "session_id"
 SESSIONS: dict[str, int] = {}
 
+# Per-route token buckets: (tokens refilled per second, burst size)
+RATE_LIMITS: dict[str, tuple[float, int]] = {
+    "login": (0.5, 5),
+    "register": (0.1, 3),
+    "upload": (0.2, 5),
+}
+# Max number of expensive requests (hashing, image work) running at once
+EXPENSIVE_CONCURRENCY = int(os.getenv("EXPENSIVE_CONCURRENCY", "4"))
+
+RESERVATION_TTL_SECONDS = 15 * 60
+RESERVATION_SWEEP_SECONDS = 30
+RESERVATION_EXPIRY_BATCH = 500
+
+# In-process job workers; set to 0 when running `python -m app.main worker` separately
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_POLL_SECONDS = 1.0
+JOB_LOCK_TIMEOUT_SECONDS = 10 * 60
+JOB_MAX_BACKOFF_SECONDS = 60 * 60
+JOB_FINISH_RETRIES = 5
+MAX_PHOTO_SIZE = 5 * 1024 * 1024  # 5MB
+
 
 @contextmanager
 def get_conn() -> Iterator[sqlite3.Connection]:
@@ -51,6 +203,39 @@ def get_conn() -> Iterator[sqlite3.Connection]:
         conn.close()
 
 
+def stream_json_array(query: str, params: Sequence[object], model: type[BaseModel]) -> StreamingResponse:
+    """Stream query rows as a JSON array, sending each batch as the cursor yields it."""
+
+    def encode_rows(rows: list[sqlite3.Row]) -> bytes:
+        return b",".join(model(**dict(row)).model_dump_json().encode("utf-8") for row in rows)
+
+    # The generator is advanced from worker threads, so the connection must not be thread-bound
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    try:
+        # Encode the first batch up front so a bad row still fails with a proper 500
+        cursor = conn.execute(query, params)
+        first_batch = encode_rows(cursor.fetchmany(STREAM_BATCH_ROWS))
+    except Exception:
+        conn.close()
+        raise
+
+    def encode() -> Iterator[bytes]:
+        # A later batch failing must abort the transfer rather than end the array early,
+        # otherwise clients would accept a shortened list as complete
+        try:
+            yield b"[" + first_batch
+            separator = b"," if first_batch else b""
+            while rows := cursor.fetchmany(STREAM_BATCH_ROWS):
+                yield separator + encode_rows(rows)
+                separator = b","
+            yield b"]"
+        finally:
+            conn.close()
+
+    return StreamingResponse(encode(), media_type="application/json")
+
+
 def ensure_column(conn: sqlite3.Connection, table: str, column: str, col_def: str) -> None:
     columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()}
     if column not in columns:
@@ -90,6 +275,80 @@ def init_db() -> None:
             """
         )
         ensure_column(conn, "products", "photo_filename", "TEXT")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS orders (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                buyer_id INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                FOREIGN KEY(buyer_id) REFERENCES profiles(id)
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS order_items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                order_id INTEGER NOT NULL,
+                product_id INTEGER NOT NULL,
+                quantity INTEGER NOT NULL,
+                unit_price REAL NOT NULL,
+                currency TEXT NOT NULL,
+                FOREIGN KEY(order_id) REFERENCES orders(id),
+                FOREIGN KEY(product_id) REFERENCES products(id)
+            )
+            """
+        )
+        ensure_column(conn, "order_items", "title", "TEXT")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS reservations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                product_id INTEGER NOT NULL,
+                buyer_id INTEGER NOT NULL,
+                quantity INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                expires_at TEXT NOT NULL,
+                FOREIGN KEY(product_id) REFERENCES products(id),
+                FOREIGN KEY(buyer_id) REFERENCES profiles(id)
+            )
+            """
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_reservations_active ON reservations(status, expires_at)"
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                priority INTEGER NOT NULL DEFAULT 0,
+                dedup_key TEXT,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL,
+                run_after TEXT NOT NULL,
+                locked_at TEXT,
+                last_error TEXT,
+                created_at TEXT NOT NULL
+            )
+            """
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs(status, priority, run_after)"
+        )
+        # Only one pending or running job per dedup key
+        conn.execute(
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_dedup ON jobs(dedup_key)
+            WHERE dedup_key IS NOT NULL AND status IN ('queued', 'running')
+            """
+        )
+        # WAL lets readers keep going while buyers write stock updates
+        conn.execute("PRAGMA journal_mode=WAL")
         
         # Set preloaded admin IDs from .env
         admin_ids_str = os.getenv("ADMIN_IDS", "").strip()
@@ -110,6 +369,43 @@ def on_startup() -> None:
     init_db()
 
 
+@app.on_event("startup")
+async def start_reservation_sweeper() -> None:
+    app.state.reservation_sweeper = asyncio.create_task(reservation_sweeper())
+
+
+@app.on_event("shutdown")
+async def stop_reservation_sweeper() -> None:
+    app.state.reservation_sweeper.cancel()
+    try:
+        await app.state.reservation_sweeper
+    except asyncio.CancelledError:
+        pass
+
+
+@app.on_event("startup")
+def start_job_workers() -> None:
+    JOBS_STOP.clear()
+    app.state.job_workers = run_job_workers(JOB_WORKERS)
+
+
+@app.on_event("shutdown")
+def stop_job_workers() -> None:
+    JOBS_STOP.set()
+    for worker in app.state.job_workers:
+        worker.join(timeout=5)
+
+
+async def reservation_sweeper() -> None:
+    while True:
+        await asyncio.sleep(RESERVATION_SWEEP_SECONDS)
+        try:
+            await run_in_threadpool(expire_reservations)
+        except Exception:
+            # Keep sweeping, otherwise expired reservations would hold stock forever
+            logger.exception("Reservation sweep failed, retrying in %s seconds", RESERVATION_SWEEP_SECONDS)
+
+
 class ProfileCreate(BaseModel):
     name: str = Field(..., min_length=2, max_length=100)
     email: EmailStr
@@ -152,6 +448,7 @@ class ProductOut(ProductCreate):
     id: int
     created_at: str
     photo_filename: Optional[str] = None
+    quantity: int = Field(default=0, ge=0)
 
 
 class RegisterPayload(BaseModel):
@@ -165,6 +462,46 @@ class LoginPayload(BaseModel):
     password: str = Field(..., min_length=6, max_length=100)
 
 
+class OrderItemIn(BaseModel):
+    product_id: int
+    quantity: int = Field(..., ge=1, le=10_000)
+
+
+class OrderCreate(BaseModel):
+    items: list[OrderItemIn] = Field(..., min_length=1, max_length=50)
+
+
+class OrderItemOut(BaseModel):
+    product_id: int
+    title: Optional[str] = None
+    quantity: int
+    unit_price: float
+    currency: str
+
+
+class OrderOut(BaseModel):
+    id: int
+    buyer_id: int
+    status: str
+    created_at: str
+    items: list[OrderItemOut]
+
+
+class ReservationCreate(BaseModel):
+    product_id: int
+    quantity: int = Field(default=1, ge=1, le=10_000)
+
+
+class ReservationOut(BaseModel):
+    id: int
+    product_id: int
+    buyer_id: int
+    quantity: int
+    status: str
+    created_at: str
+    expires_at: str
+
+
 def hash_password(password: str) -> str:
     return hashlib.sha256(password.encode("utf-8")).hexdigest()
 
@@ -201,12 +538,354 @@ def clear_session(request: Request, response: Response) -> None:
     response.delete_cookie(SESSION_COOKIE)
 
 
+class TokenBucketLimiter:
+    def __init__(self, rate: float, burst: int, max_keys: int = 10_000) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, keys: Sequence[str]) -> float:
+        """Take one token from every key, or from none of them.
+
+        Returns 0 if allowed, else seconds until all keys have a token free.
+        """
+        now = time.monotonic()
+        with self._lock:
+            levels = {}
+            for key in keys:
+                tokens, updated = self._buckets.get(key, (float(self.burst), now))
+                levels[key] = min(float(self.burst), tokens + (now - updated) * self.rate)
+            shortfall = max(1 - tokens for tokens in levels.values())
+            if shortfall > 0:
+                # Refill is computed lazily, so a rejected call needs no state written
+                return shortfall / self.rate
+            for key, tokens in levels.items():
+                self._buckets[key] = (tokens - 1, now)
+                self._buckets.move_to_end(key)
+            # Evict least recently used buckets; an evicted bucket simply starts full again
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return 0.0
+
+
+RATE_LIMITERS = {route: TokenBucketLimiter(rate, burst) for route, (rate, burst) in RATE_LIMITS.items()}
+EXPENSIVE_SLOTS = threading.BoundedSemaphore(EXPENSIVE_CONCURRENCY)
+SHED_COUNTERS: dict[str, dict[str, int]] = {
+    route: {"rate_limited": 0, "overloaded": 0} for route in RATE_LIMITS
+}
+SHED_LOCK = threading.Lock()
+
+
+def count_shed(route: str, reason: str) -> None:
+    with SHED_LOCK:
+        SHED_COUNTERS[route][reason] += 1
+
+
+def limit_route(route: str, expensive: bool = False):
+    """Dependency that sheds requests over the route budget (429) or over the expensive-route cap (503)."""
+    limiter = RATE_LIMITERS[route]
+
+    def dependency(request: Request) -> Iterator[None]:
+        keys = [f"ip:{request.client.host if request.client else 'unknown'}"]
+        # Only live sessions get their own bucket, so random cookies cannot mint new keys
+        session_id = request.cookies.get(SESSION_COOKIE)
+        if session_id and session_id in SESSIONS:
+            keys.append(f"session:{session_id}")
+        # A request rejected by one bucket must not be charged to the others
+        retry_after = limiter.acquire(keys)
+        if retry_after:
+            count_shed(route, "rate_limited")
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests",
+                headers={"Retry-After": str(math.ceil(retry_after))},
+            )
+        if not expensive:
+            yield
+            return
+        if not EXPENSIVE_SLOTS.acquire(blocking=False):
+            count_shed(route, "overloaded")
+            raise HTTPException(
+                status_code=503,
+                detail="Server busy, try again shortly",
+                headers={"Retry-After": "1"},
+            )
+        try:
+            yield
+        finally:
+            EXPENSIVE_SLOTS.release()
+
+    return dependency
+
+
+JobHandler = Callable[[dict], None]
+JOB_HANDLERS: dict[str, JobHandler] = {}
+# Called once a job has used up all its attempts
+JOB_FAILURE_HANDLERS: dict[str, JobHandler] = {}
+# Dedup hits leave no row behind, so they are counted in the enqueuing process;
+# every other job metric comes from the jobs table and covers out-of-process workers too
+JOB_COUNTERS = {"deduplicated": 0}
+JOB_LOCK = threading.Lock()
+JOBS_STOP = threading.Event()
+
+
+def job_handler(kind: str, on_failure: Optional[JobHandler] = None) -> Callable[[JobHandler], JobHandler]:
+    def register_handler(func: JobHandler) -> JobHandler:
+        JOB_HANDLERS[kind] = func
+        if on_failure is not None:
+            JOB_FAILURE_HANDLERS[kind] = on_failure
+        return func
+
+    return register_handler
+
+
+def count_job(outcome: str) -> None:
+    with JOB_LOCK:
+        JOB_COUNTERS[outcome] += 1
+
+
+def enqueue_job(
+    conn: sqlite3.Connection,
+    kind: str,
+    payload: dict,
+    priority: int = 0,
+    dedup_key: Optional[str] = None,
+    max_attempts: int = 5,
+) -> bool:
+    """Queue a job on the caller's connection so it commits with the caller's write.
+
+    Returns False if a pending job with the same dedup_key already exists.
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    cursor = conn.execute(
+        """
+        INSERT OR IGNORE INTO jobs (kind, payload, priority, dedup_key, status, max_attempts, run_after, created_at)
+        VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)
+        """,
+        (kind, json.dumps(payload), priority, dedup_key, max_attempts, now, now),
+    )
+    if cursor.rowcount == 0:
+        count_job("deduplicated")
+        return False
+    return True
+
+
+def claim_job() -> Optional[sqlite3.Row]:
+    now = datetime.now(timezone.utc)
+    stale = (now - timedelta(seconds=JOB_LOCK_TIMEOUT_SECONDS)).isoformat()
+    with get_conn() as conn:
+        # Running jobs whose lock is stale belong to a worker that died mid-job
+        job = conn.execute(
+            """
+            SELECT id, kind, payload, attempts, max_attempts FROM jobs
+            WHERE (status = 'queued' AND run_after <= ?) OR (status = 'running' AND locked_at <= ?)
+            ORDER BY priority DESC, id
+            LIMIT 1
+            """,
+            (now.isoformat(), stale),
+        ).fetchone()
+        if not job:
+            return None
+        # Claim only if no other worker got there first
+        cursor = conn.execute(
+            """
+            UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_at = ?
+            WHERE id = ? AND attempts = ? AND (status = 'queued' OR (status = 'running' AND locked_at <= ?))
+            """,
+            (now.isoformat(), job["id"], job["attempts"], stale),
+        )
+    return job if cursor.rowcount else None
+
+
+def run_job(job: sqlite3.Row) -> None:
+    attempts = job["attempts"] + 1
+    try:
+        handler = JOB_HANDLERS.get(job["kind"])
+        if handler is None:
+            raise ValueError(f"No handler for job kind {job['kind']!r}")
+        handler(json.loads(job["payload"]))
+    except Exception as e:
+        now = datetime.now(timezone.utc)
+        if attempts < job["max_attempts"]:
+            backoff = min(JOB_MAX_BACKOFF_SECONDS, 5 * 2 ** attempts)
+            run_after = (now + timedelta(seconds=backoff)).isoformat()
+            status = "queued"
+        else:
+            run_after, status = now.isoformat(), "failed"
+        logger.warning("Job %s (%s) attempt %s failed: %s", job["id"], job["kind"], attempts, e)
+        if status == "failed" and job["kind"] in JOB_FAILURE_HANDLERS:
+            try:
+                JOB_FAILURE_HANDLERS[job["kind"]](json.loads(job["payload"]))
+            except Exception:
+                logger.exception("Failure handler for job %s (%s) failed", job["id"], job["kind"])
+        finish_job(job["id"], status, run_after, str(e))
+        return
+    finish_job(job["id"], "done", None, None)
+
+
+def job_stats(conn: sqlite3.Connection) -> dict:
+    row = conn.execute(
+        """
+        SELECT
+            COALESCE(SUM(status = 'done'), 0) AS succeeded,
+            COALESCE(SUM(status = 'failed'), 0) AS failed,
+            -- Every attempt except one still running or final was a failure that got requeued
+            COALESCE(SUM(CASE WHEN status = 'queued' THEN attempts ELSE MAX(attempts - 1, 0) END), 0) AS retried
+        FROM jobs
+        """
+    ).fetchone()
+    rows = conn.execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status").fetchall()
+    return {**dict(row), "by_status": {row["status"]: row["count"] for row in rows}}
+
+
+def finish_job(job_id: int, status: str, run_after: Optional[str], error: Optional[str]) -> None:
+    for attempt in range(JOB_FINISH_RETRIES):
+        try:
+            with get_conn() as conn:
+                conn.execute(
+                    """
+                    UPDATE jobs SET status = ?, run_after = COALESCE(?, run_after), locked_at = NULL, last_error = ?
+                    WHERE id = ?
+                    """,
+                    (status, run_after, error, job_id),
+                )
+            return
+        except sqlite3.OperationalError:
+            JOBS_STOP.wait(2 ** attempt)
+    # The job stays running and is picked up again once its lock goes stale
+    logger.error("Could not record status %r for job %s", status, job_id)
+
+
+def job_worker() -> None:
+    while not JOBS_STOP.is_set():
+        try:
+            job = claim_job()
+        except sqlite3.OperationalError:
+            job = None  # Database busy, poll again
+        if job is None:
+            JOBS_STOP.wait(JOB_POLL_SECONDS)
+            continue
+        try:
+            run_job(job)
+        except Exception:
+            # Never let one job take the worker thread down with it
+            logger.exception("Job %s crashed the worker", job["id"])
+
+
+def run_job_workers(count: int) -> list[threading.Thread]:
+    workers = [threading.Thread(target=job_worker, name=f"job-worker-{i}", daemon=True) for i in range(count)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def compress_image(contents: bytes, max_size: int) -> bytes:
+    image = Image.open(BytesIO(contents))
+
+    # Convert RGBA to RGB if needed (for JPEG compatibility)
+    if image.mode in ("RGBA", "LA", "P"):
+        rgb_image = Image.new("RGB", image.size, (255, 255, 255))
+        rgb_image.paste(image, mask=image.split()[-1] if image.mode in ("RGBA", "LA") else None)
+        image = rgb_image
+
+    # Compress with decreasing quality until under max_size
+    quality = 95
+    while quality > 10:
+        output = BytesIO()
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+        compressed_data = output.getvalue()
+
+        if len(compressed_data) <= max_size:
+            return compressed_data
+
+        quality -= 10
+
+    # If still too large, resize image
+    scale = 0.9
+    while len(contents) > max_size and scale > 0.3:
+        new_size = (int(image.width * scale), int(image.height * scale))
+        resized = image.resize(new_size, Image.Resampling.LANCZOS)
+
+        output = BytesIO()
+        resized.save(output, format="JPEG", quality=85, optimize=True)
+        contents = output.getvalue()
+
+        scale -= 0.1
+    return contents
+
+
+def check_image(contents: bytes) -> None:
+    # Decode fully; Image.open alone only reads the header and misses truncated files
+    with Image.open(BytesIO(contents)) as image:
+        image.load()
+
+
+def drop_uncompressed_photo(payload: dict) -> None:
+    # Never leave an oversized original live once compression has given up
+    filename = Path(payload["filename"]).name
+    with get_conn() as conn:
+        conn.execute(
+            "UPDATE products SET photo_filename = NULL WHERE id = ? AND photo_filename = ?",
+            (payload["product_id"], filename),
+        )
+    (UPLOADS_DIR / filename).unlink(missing_ok=True)
+
+
+@job_handler("compress_photo", on_failure=drop_uncompressed_photo)
+def compress_photo_job(payload: dict) -> None:
+    source = UPLOADS_DIR / Path(payload["filename"]).name
+    if not source.exists():
+        return  # Photo was replaced or deleted before we got to it
+    contents = compress_image(source.read_bytes(), MAX_PHOTO_SIZE)
+    filename = f"product_{payload['product_id']}_{uuid.uuid4().hex}.jpg"
+    (UPLOADS_DIR / filename).write_bytes(contents)
+    with get_conn() as conn:
+        cursor = conn.execute(
+            "UPDATE products SET photo_filename = ? WHERE id = ? AND photo_filename = ?",
+            (filename, payload["product_id"], source.name),
+        )
+    (source if cursor.rowcount else UPLOADS_DIR / filename).unlink(missing_ok=True)
+
+
+@job_handler("delete_upload")
+def delete_upload_job(payload: dict) -> None:
+    (UPLOADS_DIR / Path(payload["filename"]).name).unlink(missing_ok=True)
+
+
+def enqueue_upload_cleanup(conn: sqlite3.Connection, filenames: Sequence[Optional[str]]) -> None:
+    for filename in filenames:
+        if filename:
+            enqueue_job(conn, "delete_upload", {"filename": filename}, dedup_key=f"delete_upload:{filename}")
+
+
 @app.get("/health")
 @app.get("/api/health")
 def health() -> dict:
     return {"status": "ok"}
 
 
+@app.get("/api/metrics")
+def metrics(request: Request) -> dict:
+    user_id = require_user_id(request)
+    with SHED_LOCK:
+        shed = {route: dict(counts) for route, counts in SHED_COUNTERS.items()}
+    with JOB_LOCK:
+        jobs = dict(JOB_COUNTERS)
+    with get_conn() as conn:
+        current_user = conn.execute(
+            "SELECT is_admin FROM profiles WHERE id = ?",
+            (user_id,),
+        ).fetchone()
+
+        if not current_user or not current_user["is_admin"]:
+            raise HTTPException(status_code=403, detail="Admin access required")
+
+        jobs.update(job_stats(conn))
+    return {"shed": shed, "jobs": jobs}
+
+
 @app.get("/")
 def home() -> FileResponse:
     if not HOME_PAGE.exists():
@@ -247,7 +926,7 @@ def about_page() -> FileResponse:
     return FileResponse(ABOUT_PAGE)
 
 
-@app.post("/api/auth/register", response_model=ProfileOut)
+@app.post("/api/auth/register", response_model=ProfileOut, dependencies=[Depends(limit_route("register", expensive=True))])
 def register(payload: RegisterPayload, response: Response) -> ProfileOut:
     created_at = datetime.now(timezone.utc).isoformat()
     password_hash = hash_password(payload.password)
@@ -275,7 +954,7 @@ def register(payload: RegisterPayload, response: Response) -> ProfileOut:
     return ProfileOut(**dict(row))
 
 
-@app.post("/api/auth/login", response_model=ProfileOut)
+@app.post("/api/auth/login", response_model=ProfileOut, dependencies=[Depends(limit_route("login", expensive=True))])
 def login(payload: LoginPayload, response: Response) -> ProfileOut:
     password_hash = hash_password(payload.password)
     with get_conn() as conn:
@@ -456,7 +1135,7 @@ def create_product_for_me(payload: ProductSelfCreate, request: Request) -> Produ
 def list_products(
     owner_id: Optional[int] = None,
     q: Optional[str] = Query(default=None, min_length=2, max_length=100),
-) -> list[ProductOut]:
+) -> StreamingResponse:
     query = "SELECT id, owner_id, title, description, price, currency, quantity, created_at, photo_filename FROM products"
     params: list[object] = []
 
@@ -472,13 +1151,24 @@ def list_products(
 
     query += " ORDER BY created_at DESC"
 
-    with get_conn() as conn:
-        rows = conn.execute(query, params).fetchall()
-    return [ProductOut(**dict(row)) for row in rows]
+    return stream_json_array(query, params, ProductOut)
+
 
+@app.post("/api/products/{product_id}/upload-photo", dependencies=[Depends(limit_route("upload", expensive=True))])
+async def upload_product_photo(product_id: int, request: Request) -> dict:
+    """Store a product photo sent as the multipart "file" field.
+
+    Photos over 5MB are compressed in the background and the response has "processing": true.
+    The returned url is only valid until that finishes: photo_filename then switches to the
+    compressed .jpg and the original is deleted, so re-read the product to get the final url.
+    """
+    # The form is parsed here rather than as a File(...) parameter so the rate limiter
+    # runs before the body is received; FastAPI reads body parameters before dependencies
+    form = await request.form()
+    file = form.get("file")
+    if not isinstance(file, UploadFile):
+        raise HTTPException(status_code=400, detail="Photo file is required")
 
-@app.post("/api/products/{product_id}/upload-photo")
-async def upload_product_photo(product_id: int, file: UploadFile = File(...)) -> dict:
     # Validate file type
     allowed_types = {"image/jpeg", "image/png", "image/webp", "image/gif"}
     if file.content_type not in allowed_types:
@@ -486,48 +1176,14 @@ async def upload_product_photo(product_id: int, file: UploadFile = File(...)) ->
     
     # Read file contents
     contents = await file.read()
-    max_size = 5 * 1024 * 1024  # 5MB
-    
-    # Compress if larger than 5MB
-    if len(contents) > max_size:
+    needs_compression = len(contents) > MAX_PHOTO_SIZE
+
+    # Large photos are compressed by a background job; only check here that Pillow can decode them
+    if needs_compression:
         try:
-            # Open image and compress
-            image = Image.open(BytesIO(contents))
-            
-            # Convert RGBA to RGB if needed (for JPEG compatibility)
-            if image.mode in ("RGBA", "LA", "P"):
-                rgb_image = Image.new("RGB", image.size, (255, 255, 255))
-                rgb_image.paste(image, mask=image.split()[-1] if image.mode in ("RGBA", "LA") else None)
-                image = rgb_image
-            
-            # Compress with decreasing quality until under 5MB
-            quality = 95
-            while quality > 10:
-                output = BytesIO()
-                image.save(output, format="JPEG", quality=quality, optimize=True)
-                compressed_data = output.getvalue()
-                
-                if len(compressed_data) <= max_size:
-                    contents = compressed_data
-                    break
-                
-                quality -= 10
-            
-            # If still too large, resize image
-            if len(contents) > max_size:
-                scale = 0.9
-                while len(contents) > max_size and scale > 0.3:
-                    new_size = (int(image.width * scale), int(image.height * scale))
-                    resized = image.resize(new_size, Image.Resampling.LANCZOS)
-                    
-                    output = BytesIO()
-                    resized.save(output, format="JPEG", quality=85, optimize=True)
-                    contents = output.getvalue()
-                    
-                    scale -= 0.1
+            await run_in_threadpool(check_image, contents)
         except Exception as e:
-            # If compression fails, reject the file
-            raise HTTPException(status_code=400, detail=f"Failed to compress image: {str(e)}")
+            raise HTTPException(status_code=400, detail=f"Failed to read image: {str(e)}")
     
     # Verify product exists
     with get_conn() as conn:
@@ -539,34 +1195,50 @@ async def upload_product_photo(product_id: int, file: UploadFile = File(...)) ->
             raise HTTPException(status_code=404, detail="Product not found")
     
     # Generate filename with product_id and timestamp
-    file_ext = "jpg" if len(contents) > max_size // 2 or file.content_type == "image/jpeg" else (file.filename.split(".")[-1] if "." in file.filename else "jpg")
+    file_ext = "jpg" if file.content_type == "image/jpeg" else (file.filename.split(".")[-1] if "." in file.filename else "jpg")
     filename = f"product_{product_id}_{uuid.uuid4().hex}.{file_ext}"
     filepath = UPLOADS_DIR / filename
     
-    # Save compressed file
+    # Save uploaded file
     with open(filepath, "wb") as f:
         f.write(contents)
     
-    # Update database
+    # Update database and queue follow-up work in the same transaction; take the write lock
+    # before reading the old filename so a concurrent upload or compress job cannot swap it first
     with get_conn() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        previous = conn.execute(
+            "SELECT photo_filename FROM products WHERE id = ?",
+            (product_id,),
+        ).fetchone()
         conn.execute(
             "UPDATE products SET photo_filename = ? WHERE id = ?",
             (filename, product_id),
         )
+        if previous:
+            enqueue_upload_cleanup(conn, [previous["photo_filename"]])
+        if needs_compression:
+            enqueue_job(
+                conn,
+                "compress_photo",
+                {"product_id": product_id, "filename": filename},
+                priority=10,
+                dedup_key=f"compress_photo:{filename}",
+            )
     
     return {
         "filename": filename,
         "url": f"/uploads/{filename}",
+        "processing": needs_compression,
     }
 
 @app.get("/api/profiles/{profile_id}/products", response_model=list[ProductOut])
-def list_products_by_profile(profile_id: int) -> list[ProductOut]:
-    with get_conn() as conn:
-        rows = conn.execute(
-            "SELECT id, owner_id, title, description, price, currency, quantity, created_at, photo_filename FROM products WHERE owner_id = ? ORDER BY created_at DESC",
-            (profile_id,),
-        ).fetchall()
-    return [ProductOut(**dict(row)) for row in rows]
+def list_products_by_profile(profile_id: int) -> StreamingResponse:
+    return stream_json_array(
+        "SELECT id, owner_id, title, description, price, currency, quantity, created_at, photo_filename FROM products WHERE owner_id = ? ORDER BY created_at DESC",
+        (profile_id,),
+        ProductOut,
+    )
 
 
 @app.delete("/api/products/{product_id}")
@@ -575,7 +1247,7 @@ def delete_product(product_id: int, request: Request) -> dict:
     with get_conn() as conn:
         # Get product and check ownership/admin status
         product = conn.execute(
-            "SELECT owner_id FROM products WHERE id = ?",
+            "SELECT owner_id, photo_filename FROM products WHERE id = ?",
             (product_id,),
         ).fetchone()
         
@@ -594,12 +1266,193 @@ def delete_product(product_id: int, request: Request) -> dict:
         if not (is_owner or is_admin):
             raise HTTPException(status_code=403, detail="Only owner or admin can delete this product")
         
-        # Delete the product
+        # Delete the product; its active reservations can no longer be confirmed.
+        # Orders keep their line items as purchase history.
+        conn.execute(
+            "UPDATE reservations SET status = 'cancelled' WHERE product_id = ? AND status = 'active'",
+            (product_id,),
+        )
         conn.execute("DELETE FROM products WHERE id = ?", (product_id,))
+        enqueue_upload_cleanup(conn, [product["photo_filename"]])
     
     return {"status": "deleted", "product_id": product_id}
 
 
+def take_stock(conn: sqlite3.Connection, product_id: int, quantity: int) -> None:
+    # Check and decrement in one statement so concurrent buyers can never oversell
+    cursor = conn.execute(
+        "UPDATE products SET quantity = quantity - ? WHERE id = ? AND quantity >= ?",
+        (quantity, product_id, quantity),
+    )
+    if cursor.rowcount == 0:
+        exists = conn.execute("SELECT 1 FROM products WHERE id = ?", (product_id,)).fetchone()
+        if not exists:
+            raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
+        raise HTTPException(status_code=409, detail=f"Insufficient stock for product {product_id}")
+
+
+def insert_order(conn: sqlite3.Connection, buyer_id: int, lines: dict[int, int]) -> OrderOut:
+    created_at = datetime.now(timezone.utc).isoformat()
+    cursor = conn.execute(
+        "INSERT INTO orders (buyer_id, status, created_at) VALUES (?, ?, ?)",
+        (buyer_id, "placed", created_at),
+    )
+    order_id = cursor.lastrowid
+    # Line items snapshot title and price so the order still reads correctly if the product is deleted later
+    cursor = conn.executemany(
+        """
+        INSERT INTO order_items (order_id, product_id, title, quantity, unit_price, currency)
+        SELECT ?, id, title, ?, price, currency FROM products WHERE id = ?
+        """,
+        [(order_id, quantity, product_id) for product_id, quantity in lines.items()],
+    )
+    if cursor.rowcount < len(lines):
+        raise HTTPException(status_code=409, detail="Product is no longer available")
+    return get_order_out(conn, order_id)
+
+
+def get_order_out(conn: sqlite3.Connection, order_id: int) -> Optional[OrderOut]:
+    order = conn.execute(
+        "SELECT id, buyer_id, status, created_at FROM orders WHERE id = ?",
+        (order_id,),
+    ).fetchone()
+    if not order:
+        return None
+    items = conn.execute(
+        "SELECT product_id, title, quantity, unit_price, currency FROM order_items WHERE order_id = ? ORDER BY id",
+        (order_id,),
+    ).fetchall()
+    return OrderOut(**dict(order), items=[OrderItemOut(**dict(item)) for item in items])
+
+
+def expire_reservations(batch_size: int = RESERVATION_EXPIRY_BATCH) -> int:
+    """Return stock held by expired reservations, one batch per transaction."""
+    expired = 0
+    while True:
+        now = datetime.now(timezone.utc).isoformat()
+        with get_conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            ids = [
+                row["id"]
+                for row in conn.execute(
+                    "SELECT id FROM reservations WHERE status = 'active' AND expires_at <= ? LIMIT ?",
+                    (now, batch_size),
+                ).fetchall()
+            ]
+            if not ids:
+                return expired
+            placeholders = ", ".join("?" for _ in ids)
+            conn.execute(
+                f"""
+                UPDATE products SET quantity = quantity + (
+                    SELECT SUM(r.quantity) FROM reservations r
+                    WHERE r.product_id = products.id AND r.id IN ({placeholders})
+                )
+                WHERE id IN (SELECT product_id FROM reservations WHERE id IN ({placeholders}))
+                """,
+                ids + ids,
+            )
+            conn.execute(
+                f"UPDATE reservations SET status = 'expired' WHERE id IN ({placeholders})",
+                ids,
+            )
+        expired += len(ids)
+        if len(ids) < batch_size:
+            return expired
+
+
+@app.post("/api/orders", response_model=OrderOut)
+def create_order(payload: OrderCreate, request: Request) -> OrderOut:
+    user_id = require_user_id(request)
+    lines: dict[int, int] = {}
+    for item in payload.items:
+        lines[item.product_id] = lines.get(item.product_id, 0) + item.quantity
+    # All decrements and the order rows commit together or not at all
+    with get_conn() as conn:
+        for product_id in sorted(lines):
+            take_stock(conn, product_id, lines[product_id])
+        return insert_order(conn, user_id, lines)
+
+
+@app.get("/api/orders/{order_id}", response_model=OrderOut)
+def get_order(order_id: int, request: Request) -> OrderOut:
+    user_id = require_user_id(request)
+    with get_conn() as conn:
+        order = get_order_out(conn, order_id)
+    if not order or order.buyer_id != user_id:
+        raise HTTPException(status_code=404, detail="Order not found")
+    return order
+
+
+@app.post("/api/reservations", response_model=ReservationOut)
+def create_reservation(payload: ReservationCreate, request: Request) -> ReservationOut:
+    user_id = require_user_id(request)
+    now = datetime.now(timezone.utc)
+    created_at = now.isoformat()
+    expires_at = (now + timedelta(seconds=RESERVATION_TTL_SECONDS)).isoformat()
+    with get_conn() as conn:
+        take_stock(conn, payload.product_id, payload.quantity)
+        cursor = conn.execute(
+            """
+            INSERT INTO reservations (product_id, buyer_id, quantity, status, created_at, expires_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (payload.product_id, user_id, payload.quantity, "active", created_at, expires_at),
+        )
+    return ReservationOut(
+        id=cursor.lastrowid,
+        product_id=payload.product_id,
+        buyer_id=user_id,
+        quantity=payload.quantity,
+        status="active",
+        created_at=created_at,
+        expires_at=expires_at,
+    )
+
+
+@app.post("/api/reservations/{reservation_id}/confirm", response_model=OrderOut)
+def confirm_reservation(reservation_id: int, request: Request) -> OrderOut:
+    user_id = require_user_id(request)
+    now = datetime.now(timezone.utc).isoformat()
+    with get_conn() as conn:
+        # Stock was already taken when reserving; only flip the status if still active
+        cursor = conn.execute(
+            """
+            UPDATE reservations SET status = 'confirmed'
+            WHERE id = ? AND buyer_id = ? AND status = 'active' AND expires_at > ?
+            """,
+            (reservation_id, user_id, now),
+        )
+        if cursor.rowcount == 0:
+            raise HTTPException(status_code=409, detail="Reservation not found or no longer active")
+        reservation = conn.execute(
+            "SELECT product_id, quantity FROM reservations WHERE id = ?",
+            (reservation_id,),
+        ).fetchone()
+        return insert_order(conn, user_id, {reservation["product_id"]: reservation["quantity"]})
+
+
+@app.delete("/api/reservations/{reservation_id}")
+def cancel_reservation(reservation_id: int, request: Request) -> dict:
+    user_id = require_user_id(request)
+    with get_conn() as conn:
+        cursor = conn.execute(
+            "UPDATE reservations SET status = 'cancelled' WHERE id = ? AND buyer_id = ? AND status = 'active'",
+            (reservation_id, user_id),
+        )
+        if cursor.rowcount == 0:
+            raise HTTPException(status_code=409, detail="Reservation not found or no longer active")
+        reservation = conn.execute(
+            "SELECT product_id, quantity FROM reservations WHERE id = ?",
+            (reservation_id,),
+        ).fetchone()
+        conn.execute(
+            "UPDATE products SET quantity = quantity + ? WHERE id = ?",
+            (reservation["quantity"], reservation["product_id"]),
+        )
+    return {"status": "cancelled", "reservation_id": reservation_id}
+
+
 @app.post("/api/profiles/{profile_id}/make-admin")
 def make_admin(profile_id: int, request: Request) -> dict:
     user_id = require_user_id(request)
@@ -634,7 +1487,7 @@ def admin_page() -> FileResponse:
 
 
 @app.get("/api/admin/users", response_model=list[ProfileOut])
-def admin_get_all_users(request: Request) -> list[ProfileOut]:
+def admin_get_all_users(request: Request) -> StreamingResponse:
     user_id = require_user_id(request)
     
     # Check if user is admin
@@ -647,25 +1500,16 @@ def admin_get_all_users(request: Request) -> list[ProfileOut]:
         if not current_user or not current_user["is_admin"]:
             raise HTTPException(status_code=403, detail="Admin access required")
         
-        # Get all users
-        rows = conn.execute("SELECT * FROM profiles ORDER BY created_at DESC").fetchall()
-        return [
-            ProfileOut(
-                id=row["id"],
-                name=row["name"],
-                email=row["email"],
-                phone=row["phone"],
-                city=row["city"],
-                about=row["about"],
-                created_at=row["created_at"],
-                is_admin=bool(row["is_admin"]),
-            )
-            for row in rows
-        ]
+    # Get all users
+    return stream_json_array(
+        "SELECT id, name, email, phone, city, about, created_at, is_admin FROM profiles ORDER BY created_at DESC",
+        (),
+        ProfileOut,
+    )
 
 
 @app.get("/api/admin/products", response_model=list[ProductOut])
-def admin_get_all_products(request: Request) -> list[ProductOut]:
+def admin_get_all_products(request: Request) -> StreamingResponse:
     user_id = require_user_id(request)
     
     # Check if user is admin
@@ -678,27 +1522,12 @@ def admin_get_all_products(request: Request) -> list[ProductOut]:
         if not current_user or not current_user["is_admin"]:
             raise HTTPException(status_code=403, detail="Admin access required")
         
-        # Get all products
-        rows = conn.execute("SELECT * FROM products ORDER BY created_at DESC").fetchall()
-        return [
-            ProductOut(
-                id=row["id"],
-                owner_id=row["owner_id"],
-                title=row["title"],
-                description=row["description"],
-                price=row["price"],
-                currency=row["currency"],
-                quantity=row["quantity"],
-                created_at=row["created_at"],
-                email="",  # Dummy field for response model
-                phone=None,
-                city=None,
-                about=None,
-                name="",
-                photo_filename=row["photo_filename"],
-            )
-            for row in rows
-        ]
+    # Get all products
+    return stream_json_array(
+        "SELECT id, owner_id, title, description, price, currency, quantity, created_at, photo_filename FROM products ORDER BY created_at DESC",
+        (),
+        ProductOut,
+    )
 
 
 @app.delete("/api/admin/users/{user_id}")
@@ -719,8 +1548,33 @@ def admin_delete_user(user_id: int, request: Request) -> dict:
         if user_id == admin_user_id:
             raise HTTPException(status_code=400, detail="Cannot delete your own account")
         
+        # Release stock held by the user's own reservations on other sellers' products
+        conn.execute(
+            """
+            UPDATE products SET quantity = quantity + (
+                SELECT SUM(r.quantity) FROM reservations r
+                WHERE r.product_id = products.id AND r.buyer_id = ? AND r.status = 'active'
+            )
+            WHERE id IN (SELECT product_id FROM reservations WHERE buyer_id = ? AND status = 'active')
+            """,
+            (user_id, user_id),
+        )
+        conn.execute(
+            """
+            UPDATE reservations SET status = 'cancelled'
+            WHERE status = 'active'
+              AND (buyer_id = ? OR product_id IN (SELECT id FROM products WHERE owner_id = ?))
+            """,
+            (user_id, user_id),
+        )
+
         # Delete user's products first
+        photos = conn.execute(
+            "SELECT photo_filename FROM products WHERE owner_id = ?",
+            (user_id,),
+        ).fetchall()
         conn.execute("DELETE FROM products WHERE owner_id = ?", (user_id,))
+        enqueue_upload_cleanup(conn, [row["photo_filename"] for row in photos])
         
         # Delete user
         cursor = conn.execute("DELETE FROM profiles WHERE id = ?", (user_id,))
@@ -729,3 +1583,21 @@ def admin_delete_user(user_id: int, request: Request) -> dict:
             raise HTTPException(status_code=404, detail="User not found")
     
     return {"status": "deleted", "user_id": user_id}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Marketplace background tasks")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    worker_parser = subcommands.add_parser("worker", help="Run background job workers")
+    worker_parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    init_db()
+    workers = run_job_workers(args.workers)
+    try:
+        while any(worker.is_alive() for worker in workers):
+            JOBS_STOP.wait(1)
+    except KeyboardInterrupt:
+        JOBS_STOP.set()
+        for worker in workers:
+            worker.join(timeout=5)
@@ -0,0 +1,51 @@
+import secrets
+import sys
+from collections import OrderedDict
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import app.main as main  # noqa: E402
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "DB_PATH", tmp_path / "data.db")
+    monkeypatch.setattr(main, "UPLOADS_DIR", tmp_path)
+    monkeypatch.setattr(main, "JOB_WORKERS", 0)
+    monkeypatch.setattr(main, "SESSIONS", {})
+    monkeypatch.setattr(main, "JOB_COUNTERS", {"deduplicated": 0})
+    monkeypatch.setattr(main, "JOB_HANDLERS", dict(main.JOB_HANDLERS))
+    monkeypatch.setattr(main, "JOB_FAILURE_HANDLERS", dict(main.JOB_FAILURE_HANDLERS))
+    for limiter in main.RATE_LIMITERS.values():
+        monkeypatch.setattr(limiter, "_buckets", OrderedDict())
+    monkeypatch.setattr(
+        main, "SHED_COUNTERS", {route: {"rate_limited": 0, "overloaded": 0} for route in main.RATE_LIMITS}
+    )
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def make_buyers(client):
+    """Create buyer profiles with live sessions, returning one Cookie header per buyer."""
+
+    def create(count: int) -> list[dict]:
+        created_at = datetime.now(timezone.utc).isoformat()
+        headers = []
+        with main.get_conn() as conn:
+            for _ in range(count):
+                cursor = conn.execute(
+                    "INSERT INTO profiles (name, email, created_at) VALUES (?, ?, ?)",
+                    ("Buyer", f"{secrets.token_hex(8)}@example.kz", created_at),
+                )
+                session_id = secrets.token_hex(16)
+                main.SESSIONS[session_id] = cursor.lastrowid
+                headers.append({"Cookie": f"{main.SESSION_COOKIE}={session_id}"})
+        return headers
+
+    return create
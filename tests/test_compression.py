@@ -0,0 +1,106 @@
+import gzip
+
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import ValidationError
+
+import app.main as main
+
+
+def seed_products(client, count: int) -> None:
+    owner = client.post("/api/profiles", json={"name": "Seller", "email": "seller@example.kz"}).json()
+    for i in range(count):
+        client.post(
+            "/api/products",
+            json={"owner_id": owner["id"], "title": f"Wheat lot {i}", "description": "Grain " * 20, "price": 100 + i},
+        )
+
+
+def expected_products() -> list[dict]:
+    with main.get_conn() as conn:
+        rows = conn.execute(
+            "SELECT id, owner_id, title, description, price, currency, quantity, created_at, photo_filename "
+            "FROM products ORDER BY created_at DESC"
+        ).fetchall()
+    return [main.ProductOut(**dict(row)).model_dump() for row in rows]
+
+
+@pytest.mark.parametrize(
+    ("header", "expected"),
+    [
+        ("gzip", "gzip"),
+        ("gzip;q=1, br;q=0.5", "gzip"),
+        ("br;q=0, gzip", "gzip"),
+        ("gzip;q=0", None),
+        ("identity", None),
+        ("", None),
+    ],
+)
+def test_choose_encoding_honours_q_values(header, expected):
+    assert main.choose_encoding(header) == expected
+
+
+@pytest.mark.skipif(main.brotli is None, reason="brotli is not installed")
+@pytest.mark.parametrize(("header", "expected"), [("br, gzip", "br"), ("gzip;q=0.8, br", "br"), ("*", "br")])
+def test_choose_encoding_prefers_brotli(header, expected):
+    assert main.choose_encoding(header) == expected
+
+
+def test_small_responses_are_not_compressed(client):
+    response = client.get("/api/health", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in response.headers
+
+
+def test_large_json_is_compressed_and_decodes_to_same_rows(client):
+    seed_products(client, 50)
+    identity = client.get("/api/products", headers={"Accept-Encoding": "identity"})
+    compressed = client.get("/api/products", headers={"Accept-Encoding": "gzip"})
+
+    assert "content-encoding" not in identity.headers
+    assert compressed.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in compressed.headers["vary"]
+    assert compressed.num_bytes_downloaded < len(identity.content) // 4
+    assert compressed.json() == identity.json() == expected_products()
+
+
+def test_compressed_file_response_gets_weak_etag(client):
+    identity = client.get("/products", headers={"Accept-Encoding": "identity"})
+    compressed = client.get("/products", headers={"Accept-Encoding": "gzip"})
+
+    assert not identity.headers["etag"].startswith("W/")
+    assert compressed.headers["content-encoding"] == "gzip"
+    assert compressed.headers["etag"] == f"W/{identity.headers['etag']}"
+
+
+def test_gzip_stream_is_a_single_valid_member(client, monkeypatch):
+    monkeypatch.setattr(main, "STREAM_BATCH_ROWS", 10)
+    seed_products(client, 35)
+    with client.stream("GET", "/api/products", headers={"Accept-Encoding": "gzip"}) as response:
+        raw = b"".join(response.iter_raw())
+    assert response.headers["content-encoding"] == "gzip"
+    assert "content-length" not in response.headers
+    assert gzip.decompress(raw).startswith(b"[")
+
+
+def test_streamed_products_match_database_rows(client, monkeypatch):
+    monkeypatch.setattr(main, "STREAM_BATCH_ROWS", 10)
+    seed_products(client, 35)
+    assert client.get("/api/products").json() == expected_products()
+
+
+def test_bad_row_in_first_batch_returns_500(client):
+    seed_products(client, 5)
+    with main.get_conn() as conn:
+        conn.execute("UPDATE products SET price = -1 WHERE id = 3")
+    response = TestClient(main.app, raise_server_exceptions=False).get("/api/products")
+    assert response.status_code == 500
+
+
+def test_bad_row_in_later_batch_aborts_the_stream(client, monkeypatch):
+    monkeypatch.setattr(main, "STREAM_BATCH_ROWS", 10)
+    seed_products(client, 50)
+    with main.get_conn() as conn:
+        # Rows stream newest first, so id 25 lands in the third batch
+        conn.execute("UPDATE products SET price = -1 WHERE id = 25")
+    with pytest.raises(ValidationError):
+        client.get("/api/products")
@@ -0,0 +1,166 @@
+import os
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+
+from PIL import Image
+
+import app.main as main
+
+
+def enqueue(kind: str, payload: dict, **kwargs) -> bool:
+    with main.get_conn() as conn:
+        return main.enqueue_job(conn, kind, payload, **kwargs)
+
+
+def job_row(job_id: int = 1):
+    with main.get_conn() as conn:
+        return conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+
+def make_failing(kind: str, on_failure=None) -> None:
+    def handler(payload: dict) -> None:
+        raise RuntimeError("boom")
+
+    main.job_handler(kind, on_failure=on_failure)(handler)
+
+
+def create_product_with_photo(filename: str, contents: bytes) -> int:
+    (main.UPLOADS_DIR / filename).write_bytes(contents)
+    with main.get_conn() as conn:
+        owner = conn.execute(
+            "INSERT INTO profiles (name, email, created_at) VALUES ('Seller', 'seller@example.kz', '2026-01-01')"
+        ).lastrowid
+        return conn.execute(
+            """
+            INSERT INTO products (owner_id, title, price, currency, quantity, created_at, photo_filename)
+            VALUES (?, 'Melon', 500, 'KZT', 1, '2026-01-01', ?)
+            """,
+            (owner, filename),
+        ).lastrowid
+
+
+def noisy_png(size: int) -> bytes:
+    output = BytesIO()
+    Image.frombytes("RGB", (size, size), os.urandom(size * size * 3)).save(output, format="PNG")
+    return output.getvalue()
+
+
+def test_dedup_key_blocks_pending_duplicates_until_job_fails(client):
+    make_failing("flaky")
+    assert enqueue("flaky", {}, dedup_key="k", max_attempts=1)
+    assert not enqueue("flaky", {}, dedup_key="k")
+    assert main.JOB_COUNTERS["deduplicated"] == 1
+
+    main.run_job(main.claim_job())
+    assert job_row()["status"] == "failed"
+    assert enqueue("flaky", {}, dedup_key="k")
+
+
+def test_failed_attempt_is_retried_with_exponential_backoff(client):
+    make_failing("flaky")
+    enqueue("flaky", {}, max_attempts=3)
+
+    before = datetime.now(timezone.utc)
+    main.run_job(main.claim_job())
+    job = job_row()
+    assert (job["status"], job["attempts"], job["last_error"]) == ("queued", 1, "boom")
+    delay = datetime.fromisoformat(job["run_after"]) - before
+    assert timedelta(seconds=9) < delay <= timedelta(seconds=11)
+    assert main.claim_job() is None
+
+    with main.get_conn() as conn:
+        conn.execute("UPDATE jobs SET run_after = ?", (before.isoformat(),))
+    before = datetime.now(timezone.utc)
+    main.run_job(main.claim_job())
+    delay = datetime.fromisoformat(job_row()["run_after"]) - before
+    assert timedelta(seconds=19) < delay <= timedelta(seconds=21)
+
+
+def test_exhausted_job_fails_and_runs_failure_handler(client):
+    failures = []
+    make_failing("flaky", on_failure=failures.append)
+    enqueue("flaky", {"n": 1}, max_attempts=1)
+
+    main.run_job(main.claim_job())
+    assert job_row()["status"] == "failed"
+    assert failures == [{"n": 1}]
+
+
+def test_jobs_run_by_priority(client):
+    main.job_handler("noop")(lambda payload: None)
+    enqueue("noop", {"name": "low"})
+    enqueue("noop", {"name": "high"}, priority=10)
+    assert main.claim_job()["payload"] == '{"name": "high"}'
+
+
+def test_stale_running_job_is_reclaimed(client):
+    main.job_handler("noop")(lambda payload: None)
+    enqueue("noop", {})
+    assert main.claim_job()["id"] == 1
+    assert main.claim_job() is None
+
+    stale = datetime.now(timezone.utc) - timedelta(seconds=main.JOB_LOCK_TIMEOUT_SECONDS + 1)
+    with main.get_conn() as conn:
+        conn.execute("UPDATE jobs SET locked_at = ?", (stale.isoformat(),))
+    job = main.claim_job()
+    assert job["id"] == 1
+    main.run_job(job)
+    assert (job_row()["status"], job_row()["attempts"]) == ("done", 2)
+
+
+def test_compress_photo_swaps_filename_and_deletes_original(client, monkeypatch):
+    monkeypatch.setattr(main, "MAX_PHOTO_SIZE", 50_000)
+    original = noisy_png(300)
+    assert len(original) > main.MAX_PHOTO_SIZE
+    product_id = create_product_with_photo("product_1_original.png", original)
+    enqueue("compress_photo", {"product_id": product_id, "filename": "product_1_original.png"})
+
+    main.run_job(main.claim_job())
+    with main.get_conn() as conn:
+        filename = conn.execute("SELECT photo_filename FROM products WHERE id = ?", (product_id,)).fetchone()[0]
+    assert filename.endswith(".jpg")
+    assert not (main.UPLOADS_DIR / "product_1_original.png").exists()
+    assert (main.UPLOADS_DIR / filename).stat().st_size <= main.MAX_PHOTO_SIZE
+    assert job_row()["status"] == "done"
+
+
+def test_compress_photo_failure_drops_the_oversized_original(client):
+    product_id = create_product_with_photo("product_1_broken.png", b"not an image" * 1000)
+    enqueue("compress_photo", {"product_id": product_id, "filename": "product_1_broken.png"}, max_attempts=1)
+
+    main.run_job(main.claim_job())
+    with main.get_conn() as conn:
+        assert conn.execute("SELECT photo_filename FROM products WHERE id = ?", (product_id,)).fetchone()[0] is None
+    assert not (main.UPLOADS_DIR / "product_1_broken.png").exists()
+    assert job_row()["status"] == "failed"
+
+
+def test_job_stats_come_from_the_jobs_table(client):
+    make_failing("flaky")
+    main.job_handler("noop")(lambda payload: None)
+    enqueue("noop", {})
+    enqueue("flaky", {}, max_attempts=2)
+    for _ in range(2):
+        main.run_job(main.claim_job())
+
+    with main.get_conn() as conn:
+        stats = main.job_stats(conn)
+    assert stats == {"succeeded": 1, "failed": 0, "retried": 1, "by_status": {"done": 1, "queued": 1}}
+
+
+def test_metrics_require_admin_and_report_table_counts(client, make_buyers):
+    admin, user = make_buyers(2)
+    with main.get_conn() as conn:
+        conn.execute("UPDATE profiles SET is_admin = 1 WHERE id = ?", (main.SESSIONS[admin["Cookie"].split("=")[1]],))
+        conn.execute(
+            """
+            INSERT INTO jobs (kind, payload, status, attempts, max_attempts, run_after, created_at)
+            VALUES ('noop', '{}', 'done', 1, 5, '2026-01-01', '2026-01-01')
+            """
+        )
+
+    assert client.get("/api/metrics").status_code == 401
+    assert client.get("/api/metrics", headers=user).status_code == 403
+    jobs = client.get("/api/metrics", headers=admin).json()["jobs"]
+    assert jobs["succeeded"] == 1
+    assert jobs["by_status"] == {"done": 1}
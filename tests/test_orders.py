@@ -0,0 +1,159 @@
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import app.main as main
+
+STOCK = 100
+BUYERS = 300
+SEQUENTIAL_SAMPLE = 50
+# Generous so slow CI machines pass, but far above what lock convoys or busy retries would give
+MIN_THROUGHPUT_RATIO = 0.25
+SQLITE_BUSY_TIMEOUT_SECONDS = 5.0
+
+
+def create_product(client, quantity: int) -> int:
+    owner = client.post("/api/profiles", json={"name": "Seller", "email": f"{secrets.token_hex(8)}@example.kz"}).json()
+    product = client.post(
+        "/api/products",
+        json={"owner_id": owner["id"], "title": "Flash sale melon", "price": 500, "quantity": quantity},
+    ).json()
+    return product["id"]
+
+
+def product_quantity(product_id: int) -> int:
+    with main.get_conn() as conn:
+        return conn.execute("SELECT quantity FROM products WHERE id = ?", (product_id,)).fetchone()["quantity"]
+
+
+def order_payload(product_id: int) -> dict:
+    return {"items": [{"product_id": product_id, "quantity": 1}]}
+
+
+def reservation_payload(product_id: int) -> dict:
+    return {"product_id": product_id, "quantity": 1}
+
+
+def timed_post(client, path: str, payload: dict, headers: dict) -> tuple[int, float]:
+    start = time.perf_counter()
+    status = client.post(path, json=payload, headers=headers).status_code
+    return status, time.perf_counter() - start
+
+
+def buy_concurrently(client, buyers: list[dict], path: str, make_payload, product_id: int) -> list[int]:
+    """Fire one request per buyer at once and check throughput holds up under contention."""
+    # Uncontended baseline: buyers one at a time against a product with plenty of stock
+    baseline_id = create_product(client, SEQUENTIAL_SAMPLE)
+    start = time.perf_counter()
+    for headers in buyers[:SEQUENTIAL_SAMPLE]:
+        client.post(path, json=make_payload(baseline_id), headers=headers)
+    sequential_rate = SEQUENTIAL_SAMPLE / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(buyers)) as pool:
+        results = list(pool.map(lambda headers: timed_post(client, path, make_payload(product_id), headers), buyers))
+    concurrent_rate = len(buyers) / (time.perf_counter() - start)
+
+    # Contention on one row must not collapse throughput or leave anyone waiting out the SQLite busy timeout
+    assert concurrent_rate >= sequential_rate * MIN_THROUGHPUT_RATIO
+    assert max(latency for _, latency in results) < SQLITE_BUSY_TIMEOUT_SECONDS
+    return [status for status, _ in results]
+
+
+def test_concurrent_orders_never_oversell(client, make_buyers):
+    product_id = create_product(client, STOCK)
+    codes = buy_concurrently(client, make_buyers(BUYERS), "/api/orders", order_payload, product_id)
+    assert codes.count(200) == STOCK
+    assert codes.count(409) == BUYERS - STOCK
+    assert product_quantity(product_id) == 0
+    with main.get_conn() as conn:
+        sold = conn.execute("SELECT SUM(quantity) FROM order_items WHERE product_id = ?", (product_id,)).fetchone()[0]
+    assert sold == STOCK
+
+
+def test_concurrent_reservations_never_oversell(client, make_buyers):
+    product_id = create_product(client, STOCK)
+    codes = buy_concurrently(client, make_buyers(BUYERS), "/api/reservations", reservation_payload, product_id)
+    assert codes.count(200) == STOCK
+    assert codes.count(409) == BUYERS - STOCK
+    assert product_quantity(product_id) == 0
+
+
+def test_multi_item_order_is_all_or_nothing(client, make_buyers):
+    plenty = create_product(client, 10)
+    scarce = create_product(client, 1)
+    [buyer] = make_buyers(1)
+    response = client.post(
+        "/api/orders",
+        json={"items": [{"product_id": plenty, "quantity": 2}, {"product_id": scarce, "quantity": 2}]},
+        headers=buyer,
+    )
+    assert response.status_code == 409
+    assert product_quantity(plenty) == 10
+    assert product_quantity(scarce) == 1
+
+
+def test_expired_reservations_return_stock(client, make_buyers):
+    product_id = create_product(client, 5)
+    for buyer in make_buyers(3):
+        assert client.post("/api/reservations", json={"product_id": product_id, "quantity": 1}, headers=buyer).status_code == 200
+    assert product_quantity(product_id) == 2
+    with main.get_conn() as conn:
+        conn.execute("UPDATE reservations SET expires_at = '2000-01-01T00:00:00+00:00'")
+    assert main.expire_reservations(batch_size=2) == 3
+    assert product_quantity(product_id) == 5
+
+
+def owner_headers(product_id: int) -> dict:
+    with main.get_conn() as conn:
+        owner_id = conn.execute("SELECT owner_id FROM products WHERE id = ?", (product_id,)).fetchone()["owner_id"]
+    session_id = secrets.token_hex(16)
+    main.SESSIONS[session_id] = owner_id
+    return {"Cookie": f"{main.SESSION_COOKIE}={session_id}"}
+
+
+def test_order_items_snapshot_title_and_price(client, make_buyers):
+    product_id = create_product(client, 5)
+    [buyer] = make_buyers(1)
+    order = client.post("/api/orders", json={"items": [{"product_id": product_id, "quantity": 2}]}, headers=buyer).json()
+    assert order["items"] == [
+        {"product_id": product_id, "title": "Flash sale melon", "quantity": 2, "unit_price": 500.0, "currency": "KZT"}
+    ]
+
+
+def test_confirming_reservation_for_vanished_product_is_rejected(client, make_buyers):
+    product_id = create_product(client, 5)
+    [buyer] = make_buyers(1)
+    reservation = client.post("/api/reservations", json={"product_id": product_id}, headers=buyer).json()
+    with main.get_conn() as conn:
+        conn.execute("DELETE FROM products WHERE id = ?", (product_id,))
+
+    response = client.post(f"/api/reservations/{reservation['id']}/confirm", headers=buyer)
+    assert response.status_code == 409
+    with main.get_conn() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0] == 0
+
+
+def test_deleting_product_cancels_its_reservations(client, make_buyers):
+    product_id = create_product(client, 5)
+    [buyer] = make_buyers(1)
+    reservation = client.post("/api/reservations", json={"product_id": product_id}, headers=buyer).json()
+    assert client.delete(f"/api/products/{product_id}", headers=owner_headers(product_id)).status_code == 200
+
+    assert client.post(f"/api/reservations/{reservation['id']}/confirm", headers=buyer).status_code == 409
+    with main.get_conn() as conn:
+        status = conn.execute("SELECT status FROM reservations WHERE id = ?", (reservation["id"],)).fetchone()[0]
+    assert status == "cancelled"
+
+
+def test_deleting_buyer_releases_reserved_stock(client, make_buyers):
+    product_id = create_product(client, 5)
+    admin, buyer = make_buyers(2)
+    with main.get_conn() as conn:
+        conn.execute("UPDATE profiles SET is_admin = 1 WHERE id = ?", (main.SESSIONS[admin["Cookie"].split("=")[1]],))
+    client.post("/api/reservations", json={"product_id": product_id, "quantity": 3}, headers=buyer)
+    assert product_quantity(product_id) == 2
+
+    buyer_id = main.SESSIONS[buyer["Cookie"].split("=")[1]]
+    assert client.delete(f"/api/admin/users/{buyer_id}", headers=admin).status_code == 200
+    assert product_quantity(product_id) == 5
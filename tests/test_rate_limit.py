@@ -0,0 +1,52 @@
+import threading
+
+import app.main as main
+
+LOGIN = {"email": "nobody@example.kz", "password": "secret1"}
+
+
+def test_login_over_budget_gets_429_with_retry_after(client):
+    _, burst = main.RATE_LIMITS["login"]
+    codes = [client.post("/api/auth/login", json=LOGIN).status_code for _ in range(burst)]
+    assert codes == [401] * burst
+
+    response = client.post("/api/auth/login", json=LOGIN)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert main.SHED_COUNTERS["login"]["rate_limited"] == 1
+
+
+def test_expensive_route_over_concurrency_cap_gets_503(client, monkeypatch):
+    monkeypatch.setattr(main, "EXPENSIVE_SLOTS", threading.BoundedSemaphore(1))
+    main.EXPENSIVE_SLOTS.acquire()
+
+    response = client.post("/api/auth/login", json=LOGIN)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert main.SHED_COUNTERS["login"]["overloaded"] == 1
+
+
+def test_rejected_call_charges_no_bucket():
+    limiter = main.TokenBucketLimiter(rate=0.001, burst=2)
+    assert limiter.acquire(["ip:a", "session:s"]) == 0
+    assert limiter.acquire(["ip:a", "session:s"]) == 0
+
+    # The session is spent, so a request from a second IP is refused without touching that IP's budget
+    assert limiter.acquire(["ip:b", "session:s"]) > 0
+    assert limiter.acquire(["ip:b"]) == 0
+    assert limiter.acquire(["ip:b"]) == 0
+    assert limiter.acquire(["ip:b"]) > 0
+
+
+def test_limiter_evicts_least_recently_used_keys():
+    limiter = main.TokenBucketLimiter(rate=0.001, burst=1, max_keys=2)
+    for key in ["a", "b", "c"]:
+        assert limiter.acquire([key]) == 0
+    assert list(limiter._buckets) == ["b", "c"]
+    # "a" was evicted, so it starts with a full bucket again
+    assert limiter.acquire(["a"]) == 0
+
+
+def test_unknown_session_cookie_gets_no_bucket(client):
+    client.post("/api/auth/login", json=LOGIN, headers={"Cookie": f"{main.SESSION_COOKIE}=made-up"})
+    assert list(main.RATE_LIMITERS["login"]._buckets) == ["ip:testclient"]